@@ -3,26 +3,44 @@
 import os
 import io
 import re
+import gc
 import json
+import html
 import time
 import asyncio
 import logging
 import random
+import atexit
+import sqlite3
+import multiprocessing
+import weakref
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
 import aiohttp
-import requests 
+import orjson
+from aiohttp import web
 import numpy as np 
 import cv2 
-from threading import Thread
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# uvloop's policy must be in place before pyrogram is imported and grabs the event loop
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 
 # --- Third-party Library Imports ---
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from pyrogram import Client, filters
+from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+from pyrogram import Client, filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton, Message,
     CallbackQuery
 )
-from flask import Flask
 from dotenv import load_dotenv
+from yarl import URL
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -52,8 +70,13 @@ OWNER_AD_LINKS = [
 ]
 
 # ---- GLOBAL STATE ----
-user_conversations = {}
+MAX_CONVERSATIONS = 10000
+CONVERSATION_TTL = 30 * 60
+user_conversations = OrderedDict()  # uid -> convo, least recently used first
+convo_last_seen = {}  # uid -> monotonic time of last access
+user_locks = weakref.WeakValueDictionary()  # a lock lives while someone holds or awaits it
 user_ad_links = {} 
+DB_FILE = "bot.db"
 USER_AD_LINKS_FILE = "user_ad_links.json"
 DEFAULT_AD_LINKS = [
     "https://www.google.com", 
@@ -63,164 +86,402 @@ DEFAULT_AD_LINKS = [
 # ---- RESOURCES URLS (Fallback) ----
 URL_FONT = "https://raw.githubusercontent.com/mahabub81/bangla-fonts/master/Kalpurush.ttf"
 URL_MODEL = "https://raw.githubusercontent.com/opencv/opencv/master/data/haarcascades/haarcascade_frontalface_default.xml"
+URL_LBP_MODEL = "https://raw.githubusercontent.com/opencv/opencv/master/data/lbpcascades/lbpcascade_frontalface_improved.xml"
+TMDB_API_BASE = URL("https://api.themoviedb.org/3")
+
+# ---- CONVERSATION STORE ----
+@dataclass(slots=True)
+class Convo:
+    details: dict
+    state: str
+    links: list = field(default_factory=list)
+    temp_name: str = ""
+    img_task: asyncio.Task | None = None
+    upload_task: asyncio.Task | None = None  # catbox upload of the badged poster
+    posted: bool = False  # card sent; HTML can be built on request
+    html_bytes: bytes | None = None  # finished post, UTF-8
+
+def user_lock(uid):
+    lock = user_locks.get(uid)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[uid] = lock
+    return lock
+
+def get_convo(uid):
+    convo = user_conversations.get(uid)
+    if convo is None:
+        return None
+    now = time.monotonic()
+    if now - convo_last_seen.get(uid, now) > CONVERSATION_TTL:
+        drop_convo(uid)
+        return None
+    user_conversations.move_to_end(uid)
+    convo_last_seen[uid] = now
+    return convo
+
+def set_convo(uid, convo):
+    user_conversations[uid] = convo
+    user_conversations.move_to_end(uid)
+    convo_last_seen[uid] = time.monotonic()
+    while len(user_conversations) > MAX_CONVERSATIONS:
+        drop_convo(next(iter(user_conversations)))
+
+def drop_convo(uid):
+    user_conversations.pop(uid, None)
+    convo_last_seen.pop(uid, None)
+
+# Entries are in access order, so expired ones are always at the front
+def expire_conversations():
+    cutoff = time.monotonic() - CONVERSATION_TTL
+    while user_conversations:
+        uid = next(iter(user_conversations))
+        if convo_last_seen.get(uid, 0) > cutoff:
+            break
+        drop_convo(uid)
+
+async def conversation_sweeper():
+    while True:
+        await asyncio.sleep(60)
+        expire_conversations()
+
+# ---- PRECOMPILED PATTERNS ----
+_YEAR_RE = re.compile(r'(.+?)\s*\(?(\d{4})\)?$')
+_INDENT_RE = re.compile(r'^[ \t]+', re.MULTILINE)
+_TMDB_RE = re.compile(r'themoviedb\.org/(movie|tv)/(\d+)')
+_IMDB_URL_RE = re.compile(r'imdb\.com/title/(tt\d+)')
+_IMDB_ID_RE = re.compile(r'\b(tt\d{7,})\b')
 
 
 # ---- ASYNC HTTP SESSION ----
+# One pooled session shared by every request (see get_session)
+HTTP_SESSION = None
+# PIL rendering runs in worker processes so it never contends for the loop's GIL
+CPU_POOL = None
+
+# Created on first use inside the running loop; recreated if something closed it
+def get_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=128, limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=60)
+        HTTP_SESSION = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=15)
+        )
+    return HTTP_SESSION
+
 async def fetch_url(url, method="GET", data=None, headers=None, json_data=None):
-    async with aiohttp.ClientSession() as session:
-        try:
-            if method == "GET":
-                async with session.get(url, timeout=10) as resp:
-                    if resp.status == 200:
-                        return await resp.json() if "application/json" in resp.headers.get("Content-Type", "") else await resp.read()
-            elif method == "POST":
-                async with session.post(url, data=data, json=json_data, headers=headers, ssl=False, timeout=15) as resp:
-                    return await resp.text()
-        except Exception as e:
-            logger.error(f"HTTP Error: {e}")
-            return None
+    try:
+        if method == "GET":
+            async with get_session().get(url, timeout=10) as resp:
+                if resp.status == 200:
+                    body = await resp.read()
+                    return orjson.loads(body) if "application/json" in resp.headers.get("Content-Type", "") else body
+        elif method == "POST":
+            async with get_session().post(url, data=data, json=json_data, headers=headers, timeout=15) as resp:
+                # Error pages are never a usable result; don't download them
+                if resp.status not in (200, 201):
+                    logger.warning(f"⚠️ POST {url} -> HTTP {resp.status}")
+                    return None
+                return await resp.text()
+    except Exception as e:
+        logger.error(f"HTTP Error: {e}")
+        return None
     return None
 
-# ---- PERSISTENCE FUNCTIONS ----
-def save_json(filename, data):
+# ---- TMDB RESPONSE CACHE (LRU + TTL, ETag revalidation) ----
+TMDB_CACHE_TTL = 6 * 3600
+TMDB_CACHE_SIZE = 512
+tmdb_cache = OrderedDict()  # url -> [expires_at, etag, data]
+tmdb_inflight = {}  # url -> task; concurrent misses for the same url share one request
+
+async def fetch_tmdb(url):
+    key = str(url)
+    entry = tmdb_cache.get(key)
+    if entry:
+        tmdb_cache.move_to_end(key)
+        if entry[0] > time.monotonic():
+            return entry[2]
+
+    task = tmdb_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_refresh_tmdb(key, url, entry))
+        tmdb_inflight[key] = task
+        task.add_done_callback(lambda _: tmdb_inflight.pop(key, None))
+    # shield: one caller giving up must not cancel the fetch for the others
+    return await asyncio.shield(task)
+
+async def _refresh_tmdb(key, url, entry):
+    now = time.monotonic()
+    headers = {"If-None-Match": entry[1]} if entry and entry[1] else None
     try:
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=4)
+        async with get_session().get(url, headers=headers, timeout=10) as resp:
+            if resp.status == 304 and entry:
+                entry[0] = now + TMDB_CACHE_TTL
+                return entry[2]
+            if resp.status != 200:
+                return None
+            data = orjson.loads(await resp.read())
+            etag = resp.headers.get("ETag")
     except Exception as e:
-        logger.error(f"Save JSON Error: {e}")
-
-def load_json(filename):
-    if os.path.exists(filename):
+        logger.error(f"TMDB Fetch Error: {e}")
+        return entry[2] if entry else None
+
+    tmdb_cache[key] = [now + TMDB_CACHE_TTL, etag, data]
+    while len(tmdb_cache) > TMDB_CACHE_SIZE:
+        tmdb_cache.popitem(last=False)
+    return data
+
+# ---- PERSISTENCE FUNCTIONS (SQLite, one row per user) ----
+SAVE_DEBOUNCE = 0.5
+dirty_ad_links = set()  # uids whose row is rewritten once per debounce window
+_flush_task = None
+
+def open_db(filename):
+    db = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS user_ad_links (uid INTEGER PRIMARY KEY, links TEXT NOT NULL)")
+    return db
+
+def load_ad_links(db):
+    return {uid: orjson.loads(links) for uid, links in db.execute("SELECT uid, links FROM user_ad_links")}
+
+db_write_lock = threading.Lock()  # executor flushes and the shutdown flush share the connection
+
+# Autocommit connection: without an explicit BEGIN every row would be its own
+# transaction (and a crash could leave half a batch written)
+def save_ad_links(db, rows):
+    params = [(uid, orjson.dumps(links).decode()) for uid, links in rows.items()]
+    with db_write_lock:
         try:
-            with open(filename, "r") as f:
-                data = json.load(f)
-                processed_data = {}
-                for k, v in data.items():
-                    if isinstance(v, str):
-                        processed_data[int(k)] = [v]
-                    else:
-                        processed_data[int(k)] = v
-                return processed_data
+            db.execute("BEGIN")
+            db.executemany("INSERT OR REPLACE INTO user_ad_links (uid, links) VALUES (?, ?)", params)
+            db.execute("COMMIT")
         except Exception as e:
-            logger.error(f"Load JSON Error: {e}")
-    return {}
-
-# Load saved data
-user_ad_links = load_json(USER_AD_LINKS_FILE)
-
-# ---- FLASK KEEP-ALIVE ----
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "🤖 Bot is Running! (Face Detect & Profit Mode Active)"
-
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
-
-def keep_alive_pinger():
-    while True:
-        try:
-            requests.get("http://localhost:8080")
-            time.sleep(600) 
-        except:
-            time.sleep(600)
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            logger.error(f"Save DB Error: {e}")
+
+def schedule_save(uid):
+    global _flush_task
+    dirty_ad_links.add(uid)
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_after(SAVE_DEBOUNCE))
+
+def _take_dirty_rows():
+    rows = {uid: user_ad_links[uid] for uid in dirty_ad_links if uid in user_ad_links}
+    dirty_ad_links.clear()
+    return rows
+
+async def _flush_after(delay):
+    await asyncio.sleep(delay)
+    # Snapshot on the loop thread so handlers can keep mutating the live dict
+    rows = _take_dirty_rows()
+    if rows:
+        await asyncio.get_running_loop().run_in_executor(None, save_ad_links, db, rows)
+
+def flush_pending_saves():
+    rows = _take_dirty_rows()
+    if rows:
+        save_ad_links(db, rows)
+
+# Legacy JSON store, imported into SQLite on first start
+def load_json(filename):
+    try:
+        with open(filename, "rb") as f:
+            data = orjson.loads(f.read())
+        # Old entries stored a single link as a bare string
+        return {int(k): [v] if isinstance(v, str) else v for k, v in data.items()}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Load JSON Error: {e}")
+        return {}
+
+# Load saved data. Called from on_startup, not at import: render workers
+# re-import this module and must not open the database
+db = None
+
+def init_storage():
+    global db, user_ad_links
+    db = open_db(DB_FILE)
+    user_ad_links = load_ad_links(db)
+    if not user_ad_links:
+        user_ad_links = load_json(USER_AD_LINKS_FILE)
+        if user_ad_links:
+            save_ad_links(db, user_ad_links)
+            logger.info(f"✅ Imported {len(user_ad_links)} users from {USER_AD_LINKS_FILE}")
+    atexit.register(flush_pending_saves)
+
+# ---- KEEP-ALIVE WEB SERVER (aiohttp, runs on the bot's event loop) ----
+# Hosting platforms / external uptime monitors poll these; the bot never pings itself
+web_runner = None
+
+async def home(request):
+    return web.Response(text="🤖 Bot is Running! (Face Detect & Profit Mode Active)")
+
+async def start_web_server():
+    global web_runner
+    app = web.Application()
+    app.router.add_get('/', home)
+    app.router.add_get('/health', home)
+    web_runner = web.AppRunner(app)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, '0.0.0.0', 8080).start()
 
 # ============================================================================
 # 🔥 AUTOMATIC RESOURCE DOWNLOADER (Updated Logic)
 # ============================================================================
-def setup_resources():
+LBP_MODEL = "lbpcascade_frontalface_improved.xml"
+HAAR_MODEL = "haarcascade_frontalface_default.xml"
+
+async def download_resource(path, url):
+    async with get_session().get(url, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+        resp.raise_for_status()
+        body = await resp.read()
+    with open(path, "wb") as f:
+        f.write(body)
+
+# Runs in on_startup, before the bot takes updates, so fonts/models exist by the first render
+async def setup_resources():
     font_name = "kalpurush.ttf"
     if not os.path.exists(font_name):
         logger.info("⬇️ Downloading Bengali Font (kalpurush.ttf)...")
         try:
-            r = requests.get(URL_FONT)
-            with open(font_name, "wb") as f:
-                f.write(r.content)
+            await download_resource(font_name, URL_FONT)
             logger.info("✅ Font Downloaded Successfully!")
         except Exception as e:
             logger.error(f"❌ Font Download Failed: {e}")
 
-    model_name = "haarcascade_frontalface_default.xml"
-    if not os.path.exists(model_name):
-        logger.info("⬇️ Downloading Face Detection Model...")
+    # LBP is the fast path; Haar only gets fetched if LBP isn't available
+    for model_name, url in ((LBP_MODEL, URL_LBP_MODEL), (HAAR_MODEL, URL_MODEL)):
+        if os.path.exists(model_name):
+            return
+        logger.info(f"⬇️ Downloading Face Detection Model ({model_name})...")
         try:
-            r = requests.get(URL_MODEL)
-            with open(model_name, "wb") as f:
-                f.write(r.content)
+            await download_resource(model_name, url)
             logger.info("✅ Model Downloaded Successfully!")
+            return
         except Exception as e:
             logger.error(f"❌ Model Download Failed: {e}")
 
-setup_resources()
-
 # ---- FONT HELPER FUNCTION ----
-def get_font(size=60, bold=False):
+# basic=True skips Raqm/HarfBuzz shaping; only use it for Latin-only text,
+# Bengali titles and badges need complex shaping to render conjuncts.
+# Cached so each size/face is parsed once per process and its glyph cache is reused.
+@lru_cache(maxsize=32)
+def get_font(size=60, bold=False, basic=False):
+    layout = ImageFont.Layout.BASIC if basic else None
     try:
         if os.path.exists("kalpurush.ttf"):
-            return ImageFont.truetype("kalpurush.ttf", size)
+            return ImageFont.truetype("kalpurush.ttf", size, layout_engine=layout)
         font_file = "Poppins-Bold.ttf" if bold else "Poppins-Regular.ttf"
         if os.path.exists(font_file):
-             return ImageFont.truetype(font_file, size)
+             return ImageFont.truetype(font_file, size, layout_engine=layout)
         return ImageFont.load_default()
     except Exception as e:
         logger.error(f"Font Load Error: {e}")
         return ImageFont.load_default()
 
+# Text styles as get_font args; always passed positionally so each is one cache entry
+FONT_TITLE = (27, True, False)
+FONT_BODY = (18, False, False)
+FONT_META = (18, False, True)
+FONT_GENRES = (14, False, True)
+FONT_BADGE = (70, False, False)
+
+# Needs the downloaded font, so only run once setup_resources has finished
+def preload_fonts():
+    for spec in (FONT_TITLE, FONT_BODY, FONT_META, FONT_GENRES, FONT_BADGE):
+        get_font(*spec)
+
 # ---- HELPER: UPLOAD TO CATBOX ----
-def upload_to_catbox_bytes(img_bytes):
+CATBOX_URL = "https://catbox.moe/user/api.php"
+
+# Both uploads are JPEGs: Telegram photos and the badged poster
+async def upload_to_catbox_bytes(img_bytes, filename="poster.jpg", content_type="image/jpeg"):
+    form = aiohttp.FormData()
+    form.add_field("reqtype", "fileupload")
+    form.add_field("userhash", "")
+    form.add_field("fileToUpload", img_bytes, filename=filename, content_type=content_type)
     try:
-        url = "https://catbox.moe/user/api.php"
-        data = {"reqtype": "fileupload", "userhash": ""}
-        files = {"fileToUpload": ("poster.png", img_bytes, "image/png")}
-        response = requests.post(url, data=data, files=files)
-        if response.status_code == 200:
-            return response.text.strip()
+        async with get_session().post(CATBOX_URL, data=form, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+            if resp.status == 200:
+                return (await resp.text()).strip()
     except Exception as e:
         logger.error(f"Upload Error: {e}")
     return None
 
-def upload_to_catbox(file_path):
-    try:
-        with open(file_path, "rb") as f:
-            return upload_to_catbox_bytes(f)
-    except: return None
-
 # ---- TMDB & LINK EXTRACTION ----
 def extract_tmdb_id(text):
-    tmdb_match = re.search(r'themoviedb\.org/(movie|tv)/(\d+)', text)
+    tmdb_match = _TMDB_RE.search(text)
     if tmdb_match:
         return tmdb_match.group(1), tmdb_match.group(2)
-    imdb_match = re.search(r'(tt\d+)', text)
+    imdb_match = _IMDB_URL_RE.search(text) or _IMDB_ID_RE.search(text)
     if imdb_match:
         return "imdb", imdb_match.group(1)
     return None, None
 
 async def search_tmdb(query):
     try:
-        match = re.search(r'(.+?)\s*\(?(\d{4})\)?$', query)
+        match = _YEAR_RE.search(query)
         name = match.group(1).strip() if match else query.strip()
         year = match.group(2) if match else None
+        # TMDB search is case-insensitive; normalise so "Avatar" and "avatar " share a cache entry
+        name = " ".join(name.lower().split())
         
-        url = f"https://api.themoviedb.org/3/search/multi?api_key={TMDB_API_KEY}&query={name}&include_adult=true"
-        if year: url += f"&year={year}"
+        params = {"api_key": TMDB_API_KEY, "query": name, "include_adult": "true"}
+        if year: params["year"] = year
+        url = (TMDB_API_BASE / "search" / "multi").with_query(params)
         
-        data = await fetch_url(url)
+        data = await fetch_tmdb(url)
         if not data: return []
         return [r for r in data.get("results", []) if r.get("media_type") in ["movie", "tv"]][:15]
     except Exception as e:
         logger.error(f"TMDB Search Error: {e}")
         return []
 
+def tmdb_details_url(media_type, media_id):
+    return (TMDB_API_BASE / media_type / str(media_id)).with_query({"api_key": TMDB_API_KEY})
+
 async def get_tmdb_details(media_type, media_id):
-    url = f"https://api.themoviedb.org/3/{media_type}/{media_id}?api_key={TMDB_API_KEY}&append_to_response=credits,similar"
-    return await fetch_url(url)
+    data = await fetch_tmdb(tmdb_details_url(media_type, media_id))
+    # Shallow copy: the conversation flow writes its own keys into details
+    return dict(data) if data else None
+
+# Warm the details cache for the likely picks while the user reads the result list
+PREFETCH_TOP = 5
+prefetch_sem = asyncio.Semaphore(PREFETCH_TOP)  # bounds speculative TMDB calls across all users
+prefetch_tasks = set()
+
+async def _prefetch_one(media_type, media_id):
+    async with prefetch_sem:
+        await fetch_tmdb(tmdb_details_url(media_type, media_id))
+
+def prefetch_details(results):
+    for r in results[:PREFETCH_TOP]:
+        task = asyncio.create_task(_prefetch_one(r['media_type'], r['id']))
+        prefetch_tasks.add(task)
+        task.add_done_callback(prefetch_tasks.discard)
+
+# Movies carry title/release_date, TV shows name/first_air_date
+def get_title(data):
+    return data.get("title") or data.get("name")
+
+def get_year(data):
+    return (data.get("release_date") or data.get("first_air_date") or "----")[:4]
 
 # ---- DPASTE FUNCTION ----
+# Leading indentation is insignificant in the generated HTML/CSS/JS and makes up
+# a large share of the paste body.
+def compact_html(content):
+    return _INDENT_RE.sub("", content)
+
 async def create_paste_link(content):
     if not content: return None
+    if isinstance(content, bytes): content = content.decode()
     url = "https://dpaste.com/api/"
-    data = {"content": content, "syntax": "html", "expiry_days": 14, "title": "Movie Post Code"}
+    data = {"content": compact_html(content), "syntax": "html", "expiry_days": 14, "title": "Movie Post Code"}
     headers = {'User-Agent': 'Mozilla/5.0'}
     link = await fetch_url(url, method="POST", data=data, headers=headers)
     if link and "dpaste.com" in link:
@@ -230,26 +491,52 @@ async def create_paste_link(content):
 # ============================================================================
 # 🔥 FACE DETECTION & SMART BADGE PLACEMENT SYSTEM
 # ============================================================================
+FACE_CASCADE = None  # parsed once per render process
+FACE_DETECT_SCALE = 0.5
+FACE_USE_OPENCL = False  # cascades take the OpenCL (T-API) path when fed a UMat
+
+# LBP works on integer features and is 2-3x faster than Haar; boxes are plenty
+# accurate for placing a badge under the faces
+def get_face_cascade():
+    global FACE_CASCADE, FACE_USE_OPENCL
+    if FACE_CASCADE is None:
+        for model_name in (LBP_MODEL, HAAR_MODEL):
+            if os.path.exists(model_name):
+                cascade = cv2.CascadeClassifier(model_name)
+                # A truncated download still exists but loads empty; try the next model
+                if not cascade.empty():
+                    FACE_CASCADE = cascade
+                    break
+                logger.warning(f"⚠️ Could not load {model_name}, trying fallback")
+        # OpenCL is switched on per render process, on its first detection
+        try:
+            FACE_USE_OPENCL = cv2.ocl.haveOpenCL()
+            cv2.ocl.setUseOpenCL(FACE_USE_OPENCL)
+        except cv2.error:
+            FACE_USE_OPENCL = False
+    return FACE_CASCADE
+
 def get_smart_badge_position(pil_img):
     try:
-        cv_img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-        gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
-        
-        cascade_path = "haarcascade_frontalface_default.xml"
-        if not os.path.exists(cascade_path):
+        face_cascade = get_face_cascade()
+        if face_cascade is None:
             return int(pil_img.height * 0.40) 
 
-        face_cascade = cv2.CascadeClassifier(cascade_path)
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+        # Cascades only look at luminance; PIL's L conversion is a single pass
+        gray = np.asarray(pil_img.convert("L"))
+
+        # Only a coarse y is needed: detect at half size (a quarter of the windows)
+        # and map the boxes back
+        small = cv2.resize(gray, None, fx=FACE_DETECT_SCALE, fy=FACE_DETECT_SCALE, interpolation=cv2.INTER_AREA)
+        if FACE_USE_OPENCL:
+            small = cv2.UMat(small)
+        faces = face_cascade.detectMultiScale(small, 1.2, 3, minSize=(30, 30))
         
         height = pil_img.height
         
         if len(faces) > 0:
-            lowest_y = 0
-            for (x, y, w, h) in faces:
-                bottom_of_face = y + h
-                if bottom_of_face > lowest_y:
-                    lowest_y = bottom_of_face
+            faces = np.asarray(faces)
+            lowest_y = int((faces[:, 1] + faces[:, 3]).max() / FACE_DETECT_SCALE)
             
             target_y = lowest_y + 40 
             if target_y > (height - 130):
@@ -262,31 +549,37 @@ def get_smart_badge_position(pil_img):
         logger.error(f"Face Detect Error: {e}")
         return 200
 
-def apply_badge_to_poster(poster_bytes, text):
+BADGE_BOX_ALPHA = 220
+
+# Badge texts repeat a lot ("Dual Audio", "HD"...); shape each one only once
+@lru_cache(maxsize=256)
+def badge_metrics(text):
+    font = get_font(*FONT_BADGE)
+    left, top, right, bottom = font.getbbox(text)
+    words = text.split()
+    first_w = font.getlength(words[0]) if len(words) >= 2 else 0
+    return right - left, bottom - top, first_w
+
+# Works on the decoded poster and returns a new image; None if badging failed
+def apply_badge_to_poster(base_img, text):
     try:
-        base_img = Image.open(io.BytesIO(poster_bytes)).convert("RGBA")
         width, height = base_img.size
         
-        font = get_font(size=70) 
+        font = get_font(*FONT_BADGE)
         pos_y = get_smart_badge_position(base_img)
-        draw = ImageDraw.Draw(base_img)
-        
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_w = bbox[2] - bbox[0]
-        text_h = bbox[3] - bbox[1]
+        text_w, text_h, w1 = badge_metrics(text)
         
         padding_x, padding_y = 40, 20
         box_w = text_w + (padding_x * 2)
         box_h = text_h + (padding_y * 2)
         pos_x = (width - box_w) // 2
         
-        overlay = Image.new('RGBA', base_img.size, (0,0,0,0))
-        draw_overlay = ImageDraw.Draw(overlay)
-        draw_overlay.rectangle(
-            [pos_x, pos_y, pos_x + box_w, pos_y + box_h], 
-            fill=(0, 0, 0, 220) 
-        )
-        base_img = Image.alpha_composite(base_img, overlay)
+        # Black at alpha 220 over the box only: scale the ROI in place instead of
+        # compositing a full-size transparent overlay
+        arr = np.array(base_img)
+        roi = arr[max(pos_y, 0):pos_y + box_h + 1, max(pos_x, 0):pos_x + box_w + 1]
+        roi[:] = roi.astype(np.uint16) * (255 - BADGE_BOX_ALPHA) // 255
+        base_img = Image.fromarray(arr)
         draw = ImageDraw.Draw(base_img)
         
         cx = pos_x + padding_x
@@ -297,29 +590,22 @@ def apply_badge_to_poster(poster_bytes, text):
         
         if len(words) >= 2:
             draw.text((cx, cy), words[0], font=font, fill=colors[0])
-            w1 = draw.textlength(words[0], font=font)
             draw.text((cx + w1 + 15, cy), " ".join(words[1:]), font=font, fill=colors[1])
         else:
             draw.text((cx, cy), text, font=font, fill=colors[0])
-
-        img_buffer = io.BytesIO()
-        base_img.save(img_buffer, format="PNG")
-        img_buffer.seek(0)
-        return img_buffer
+        return base_img
     except Exception as e:
         logger.error(f"Badge Apply Error: {e}")
-        return io.BytesIO(poster_bytes)
+        return None
 
 # ============================================================================
 # ---- HTML GENERATOR (UPDATED WITH RULES & PROCESSING DELAY) ----
 # ============================================================================
-def generate_html_code(data, links, ad_links_list):
-    title = data.get("title") or data.get("name")
-    overview = data.get("overview", "")
-    poster = data.get('manual_poster_url') or f"https://image.tmdb.org/t/p/w500{data.get('poster_path')}"
-    BTN_TELEGRAM = "https://i.ibb.co/kVfJvhzS/photo-2025-12-23-12-38-56-7587031987190235140.jpg"   
+BTN_TELEGRAM = "https://i.ibb.co/kVfJvhzS/photo-2025-12-23-12-38-56-7587031987190235140.jpg"
+TG_JOIN_LINK = "https://t.me/+6hvCoblt6CxhZjhl"
 
-    style_html = """
+# Static blocks are built once at import; only the card body is per-post.
+_HTML_STYLE = """
     <style>
         @import url('https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600;700&display=swap');
         body { margin: 0; padding: 10px; background-color: #f0f2f5; font-family: 'Poppins', sans-serif; }
@@ -385,48 +671,53 @@ def generate_html_code(data, links, ad_links_list):
     </style>
     """
 
-    links_html = ""
-    for link in links:
-        label = link['label']
-        btn_text = "WATCH ONLINE ▶" if any(x in label.lower() for x in ["watch", "play"]) else "DOWNLOAD NOW 📥"
-        links_html += f"""
-        <div class="dl-item">
-            <span class="dl-link-label">📂 {label}</span>
-            <button class="rgb-btn dl-trigger-btn" data-url="{link['url']}" data-click-count="0">{btn_text}</button>
-            <div class="dl-timer-display">⏳ Wait: <span class="timer-count">10</span>s</div>
-            <a href="#" class="dl-real-download-link" target="_blank">✅ CLICK TO OPEN</a>
-        </div>"""
+_HTML_RULES = """
+        <!-- RULES BOX ADDED HERE -->
+        <div class="rules-box">
+            <div class="rules-title">⚠️ ডাউনলোড করার নিয়ম:</div>
+            <div class="rules-text">
+                ১. প্রথমে <b>Download Button</b> এ ক্লিক করুন।<br>
+                ২. ক্লিক করার পর <b>Processing</b> দেখাবে এবং একটি অ্যাড ওপেন হতে পারে।<br>
+                ৩. দয়া করে <b>Back</b> করে আবার বাটনে ক্লিক করুন।<br>
+                ৪. ২-৩ বার এমন হওয়ার পর <b>Original Link</b> পেয়ে যাবেন।
+            </div>
+        </div>
+"""
 
-    # 🔥 OWNER LINK INJECTION 🔥
-    final_ad_list = list(ad_links_list)
-    if OWNER_AD_LINKS:
-        final_ad_list.insert(0, random.choice(OWNER_AD_LINKS))
+_HTML_TG_JOIN = f"""
+        <div class="tg-join-section">
+            <a href="{TG_JOIN_LINK}" target="_blank">
+                <img src="{BTN_TELEGRAM}" style="width: 250px; max-width: 90%;">
+            </a>
+        </div>
+    </div>
+"""
 
-    # --- UPDATED JAVASCRIPT WITH PROCESSING DELAY ---
-    script_html = f"""
+# --- JAVASCRIPT WITH PROCESSING DELAY (__AD_LINKS__ is filled per post) ---
+_HTML_SCRIPT = """
     <script>
-    const AD_LINKS = {json.dumps(final_ad_list)}; 
-    document.querySelectorAll('.dl-trigger-btn').forEach(btn => {{
-        btn.onclick = function() {{
+    const AD_LINKS = __AD_LINKS__; 
+    document.querySelectorAll('.dl-trigger-btn').forEach(btn => {
+        btn.onclick = function() {
             // 1. Show Processing
             let originalText = this.innerText;
             this.innerText = "🔄 Processing...";
             this.disabled = true; // Disable click
 
             // 2. Wait 1.5 Seconds
-            setTimeout(() => {{
+            setTimeout(() => {
                 // Restore button
                 this.innerText = originalText;
                 this.disabled = false;
 
                 // 3. Main Logic
                 let count = parseInt(this.getAttribute('data-click-count'));
-                if(count < AD_LINKS.length) {{
+                if(count < AD_LINKS.length) {
                     // Open Ad
                     window.open(AD_LINKS[count], '_blank');
                     this.setAttribute('data-click-count', count + 1);
-                }} 
-                else {{
+                } 
+                else {
                     // Show Real Link Logic
                     this.style.display = 'none'; 
                     let timerDiv = this.nextElementSibling;
@@ -435,55 +726,71 @@ def generate_html_code(data, links, ad_links_list):
                     timerDiv.style.display = 'block';
                     let timeLeft = 3;
                     timerSpan.innerText = timeLeft;
-                    let interval = setInterval(() => {{
+                    let interval = setInterval(() => {
                         timeLeft--;
                         timerSpan.innerText = timeLeft;
-                        if(timeLeft <= 0) {{
+                        if(timeLeft <= 0) {
                             clearInterval(interval);
                             timerDiv.style.display = 'none';
                             realLink.href = this.getAttribute('data-url');
                             realLink.style.setProperty('display', 'block', 'important'); 
-                        }}
-                    }}, 1000);
-                }}
-            }}, 1500); // 1.5s Delay
-        }}
-    }});
+                        }
+                    }, 1000);
+                }
+            }, 1500); // 1.5s Delay
+        }
+    });
     </script>
     """
 
-    return f"""
-    <!-- Bot Generated Post -->
-    {style_html}
+_LINK_TPL = """
+        <div class="dl-item">
+            <span class="dl-link-label">📂 {label}</span>
+            <button class="rgb-btn dl-trigger-btn" data-url="{url}" data-click-count="0">{btn_text}</button>
+            <div class="dl-timer-display">⏳ Wait: <span class="timer-count">10</span>s</div>
+            <a href="#" class="dl-real-download-link" target="_blank">✅ CLICK TO OPEN</a>
+        </div>"""
+
+# Everything between the <style> and <script> blocks, filled with one format_map.
+_HTML_HEAD = "\n    <!-- Bot Generated Post -->\n    " + _HTML_STYLE
+_HTML_BODY = """
     <div class="main-card">
         <img src="{poster}" class="poster-img">
         <h2>{title}</h2>
         <p>{overview}</p>
-        
-        <!-- RULES BOX ADDED HERE -->
-        <div class="rules-box">
-            <div class="rules-title">⚠️ ডাউনলোড করার নিয়ম:</div>
-            <div class="rules-text">
-                ১. প্রথমে <b>Download Button</b> এ ক্লিক করুন।<br>
-                ২. ক্লিক করার পর <b>Processing</b> দেখাবে এবং একটি অ্যাড ওপেন হতে পারে।<br>
-                ৩. দয়া করে <b>Back</b> করে আবার বাটনে ক্লিক করুন।<br>
-                ৪. ২-৩ বার এমন হওয়ার পর <b>Original Link</b> পেয়ে যাবেন।
-            </div>
-        </div>
+        """ + _HTML_RULES + """
+        <div class="dl-container-area">{links_html}</div>""" + _HTML_TG_JOIN + "    "
 
-        <div class="dl-container-area">{links_html}</div>
-        <div class="tg-join-section">
-            <a href="https://t.me/+6hvCoblt6CxhZjhl" target="_blank">
-                <img src="{BTN_TELEGRAM}" style="width: 250px; max-width: 90%;">
-            </a>
-        </div>
-    </div>
-    {script_html}
-    """
+def link_button_text(label):
+    return "WATCH ONLINE ▶" if any(x in label.lower() for x in ["watch", "play"]) else "DOWNLOAD NOW 📥"
+
+def generate_html_code(data, links, ad_links_list):
+    title = get_title(data)
+    overview = data.get("overview", "")
+    poster = data.get('manual_poster_url') or f"https://image.tmdb.org/t/p/w500{data.get('poster_path')}"
+
+    links_html = "".join(
+        _LINK_TPL.format(label=html.escape(link['label'], quote=False), url=html.escape(link['url']), btn_text=link_button_text(link['label']))
+        for link in links
+    )
+
+    # 🔥 OWNER LINK INJECTION 🔥
+    final_ad_list = list(ad_links_list)
+    if OWNER_AD_LINKS:
+        final_ad_list.insert(0, random.choice(OWNER_AD_LINKS))
+
+    # Titles/plots are user or TMDB text; escape so quotes and <> can't break the markup
+    body = _HTML_BODY.format_map({
+        "poster": html.escape(poster), "title": html.escape(title or "", quote=False),
+        "overview": html.escape(overview or "", quote=False), "links_html": links_html
+    })
+    # "</" inside the JSON would close the <script> element early
+    ad_links_js = json.dumps(final_ad_list).replace("</", "<\\/")
+    return "".join((_HTML_HEAD, body, _HTML_SCRIPT.replace("__AD_LINKS__", ad_links_js), "\n    "))
 
 # ---- IMAGE & CAPTION GENERATOR ----
 def generate_formatted_caption(data):
-    title = data.get("title") or data.get("name") or "N/A"
+    title = get_title(data) or "N/A"
     
     if data.get('is_manual'):
         year = "Custom"
@@ -491,7 +798,7 @@ def generate_formatted_caption(data):
         genres = "Custom"
         language = "N/A"
     else:
-        year = (data.get("release_date") or data.get("first_air_date") or "----")[:4]
+        year = get_year(data)
         rating = f"⭐ {data.get('vote_average', 0):.1f}/10"
         genres = ", ".join([g["name"] for g in data.get("genres", [])] or ["N/A"])
         language = data.get('custom_language', '').title()
@@ -504,70 +811,231 @@ def generate_formatted_caption(data):
     caption += f"**📝 Plot:** _{overview[:300]}..._"
     return caption
 
-def generate_image(data):
+def get_poster_url(data):
+    if data.get('manual_poster_url'):
+        return data.get('manual_poster_url')
+    return f"https://image.tmdb.org/t/p/w500{data['poster_path']}" if data.get('poster_path') else None
+
+def get_backdrop_url(data):
+    if data.get('backdrop_path') and not data.get('is_manual'):
+        # Only ever used blurred at BLUR_SIZE, so the smallest TMDB size above it
+        return f"https://image.tmdb.org/t/p/w780{data['backdrop_path']}"
+    return None
+
+# TMDB image paths are content-addressed (a new image gets a new path), so a
+# cached body never needs revalidating
+IMAGE_CACHE_SIZE = 64
+image_cache = OrderedDict()  # url -> bytes, shared by prefetch and re-posts
+image_inflight = {}  # url -> task; a re-select while the first download runs joins it
+
+async def fetch_image_bytes(url):
+    if not url: return None
+    cached = image_cache.get(url)
+    if cached is not None:
+        image_cache.move_to_end(url)
+        return cached
+    task = image_inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_download_image(url))
+        image_inflight[url] = task
+        task.add_done_callback(lambda _: image_inflight.pop(url, None))
+    return await asyncio.shield(task)
+
+async def _download_image(url):
     try:
-        if data.get('manual_poster_url'):
-            poster_url = data.get('manual_poster_url')
+        async with get_session().get(url, timeout=10) as resp:
+            if resp.status == 200:
+                body = await resp.read()
+                image_cache[url] = body
+                while len(image_cache) > IMAGE_CACHE_SIZE:
+                    image_cache.popitem(last=False)
+                return body
+    except Exception as e:
+        logger.error(f"Image Fetch Error: {e}")
+    return None
+
+BACKDROP_DIM = (255 - 150) / 255
+
+# JPEG sources are scaled inside libjpeg-turbo's IDCT (draft mode) when they are
+# at least 2x the target size, so no full-resolution frame is allocated.
+def open_image(img_bytes, size=None):
+    img = Image.open(io.BytesIO(img_bytes))
+    if size and img.format == "JPEG":
+        img.draft("RGB", size)
+    return img
+
+# Card layout. 960x540 rather than 1280x720: Telegram recompresses and shows it
+# downscaled anyway, and every step below costs per pixel
+CARD_SIZE = (960, 540)
+POSTER_SIZE = (300, 450)
+POSTER_POS = (38, 45)
+TEXT_X = 360
+OVERVIEW_MAX_PX = 570  # from TEXT_X to a 30px right margin
+
+# Greedy word wrap on measured pixel width (works for Bengali where char counts lie)
+def wrap_text_px(text, font, max_px, max_lines):
+    lines, line = [], ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else word
+        if font.getlength(candidate) <= max_px:
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        # A word wider than the column on its own (URLs, unspaced text) is hard-broken
+        while font.getlength(word) > max_px:
+            cut = fit_prefix_px(word, font, max_px)
+            lines.append(word[:cut])
+            word = word[cut:]
+        line = word
+        if len(lines) >= max_lines:
+            return ellipsize_last(lines[:max_lines], font, max_px)
+    if line:
+        lines.append(line)
+    return lines
+
+# Longest prefix (at least one char) that fits in max_px, by binary search
+def fit_prefix_px(text, font, max_px):
+    lo, hi = 1, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if font.getlength(text[:mid]) <= max_px:
+            lo = mid
         else:
-            poster_url = f"https://image.tmdb.org/t/p/w500{data['poster_path']}" if data.get('poster_path') else None
-        
-        if not poster_url: return None, None
+            hi = mid - 1
+    return lo
+
+# Text was cut off: trim the last line until it fits with the "…"
+def ellipsize_last(lines, font, max_px):
+    last = lines[-1]
+    while last and font.getlength(last + "…") > max_px:
+        last = last[:-1]
+    lines[-1] = last.rstrip() + "…"
+    return lines
+
+# Poster + backdrop are downloaded concurrently on the loop; render_image stays pure CPU
+async def fetch_images(data):
+    poster_bytes, backdrop_bytes = await asyncio.gather(
+        fetch_image_bytes(get_poster_url(data)),
+        fetch_image_bytes(get_backdrop_url(data))
+    )
+    return poster_bytes, backdrop_bytes
+
+PIL_POOL = None  # per render process, created on first use
+
+def get_pil_pool():
+    global PIL_POOL
+    if PIL_POOL is None:
+        PIL_POOL = ThreadPoolExecutor(max_workers=2)
+    return PIL_POOL
+
+# Blur at half resolution: sigma 3.75 there looks like the original radius 10 at
+# 1280 wide, for a fraction of the convolution, and the result upsamples cleanly
+BLUR_SIZE = (480, 270)
+
+def blur_and_dim(img):
+    # OpenCV's separable SIMD Gaussian; PIL's radius is the sigma
+    arr = cv2.GaussianBlur(np.asarray(img.resize(BLUR_SIZE, Image.BILINEAR)), (0, 0), sigmaX=3.75)
+    img = Image.fromarray(arr)
+    # Same result as compositing black at alpha 150, in one pass and no extra canvas
+    img = ImageEnhance.Brightness(img).enhance(BACKDROP_DIM)
+    return img.resize(CARD_SIZE, Image.BILINEAR)
 
-        poster_bytes = requests.get(poster_url, timeout=10).content
+def prepare_backdrop(backdrop_bytes):
+    try:
+        return blur_and_dim(open_image(backdrop_bytes, BLUR_SIZE).convert("RGB"))
+    except: return None
+
+# Render workers live as long as the bot; a periodic full collection keeps their
+# RSS flat across posts (per process, so no cross-worker state)
+RENDER_GC_EVERY = 20
+_renders = 0
+
+def collect_render_garbage():
+    global _renders
+    _renders += 1
+    if _renders % RENDER_GC_EVERY == 0:
+        gc.collect()
+
+def render_image(poster_bytes, backdrop_bytes, data):
+    try:
+        if not poster_bytes: return None, None
         
+        # Backdrop decode+blur runs beside the badge/poster work (Pillow drops the GIL)
+        backdrop_job = get_pil_pool().submit(prepare_backdrop, backdrop_bytes) if backdrop_bytes else None
+        # Posters are opaque (TMDB JPEGs, Telegram photos)
+        badged_bytes = None
         if data.get('badge_text'):
-            badge_io = apply_badge_to_poster(poster_bytes, data['badge_text'])
-            poster_bytes = badge_io.getvalue()
-
-        poster_img = Image.open(io.BytesIO(poster_bytes)).convert("RGBA").resize((400, 600))
+            # Badge is sized for the full-resolution poster, so no draft decode here
+            with Image.open(io.BytesIO(poster_bytes)) as src:
+                poster_img = src.convert("RGB")
+            badged = apply_badge_to_poster(poster_img, data['badge_text'])
+            if badged is not None:
+                poster_img.close()
+                poster_img = badged
+                # Opaque photo going to catbox for the HTML post: JPEG is several
+                # times smaller and faster to encode than even a level-1 PNG
+                badge_buffer = io.BytesIO()
+                badged.save(badge_buffer, format="JPEG", quality=90)
+                badged_bytes = badge_buffer.getvalue()
+        else:
+            with open_image(poster_bytes, POSTER_SIZE) as src:
+                poster_img = src.convert("RGB")
+        full_img = poster_img
+        poster_img = full_img.resize(POSTER_SIZE)
+        full_img.close()
         
-        bg_img = Image.new('RGBA', (1280, 720), (10, 10, 20))
-        backdrop = None
-        if data.get('backdrop_path') and not data.get('is_manual'):
-            try:
-                bd_url = f"https://image.tmdb.org/t/p/w1280{data['backdrop_path']}"
-                bd_bytes = requests.get(bd_url, timeout=10).content
-                backdrop = Image.open(io.BytesIO(bd_bytes)).convert("RGBA").resize((1280, 720))
-            except: pass
+        bg_img = backdrop_job.result() if backdrop_job else None
         
-        if not backdrop:
-            backdrop = poster_img.resize((1280, 720))
-            
-        backdrop = backdrop.filter(ImageFilter.GaussianBlur(10))
-        bg_img = Image.alpha_composite(backdrop, Image.new('RGBA', (1280, 720), (0, 0, 0, 150))) 
+        # Whole card stays opaque RGB end-to-end
+        if bg_img is None:
+            bg_img = blur_and_dim(poster_img)
 
-        bg_img.paste(poster_img, (50, 60), poster_img)
+        bg_img.paste(poster_img, POSTER_POS)
         draw = ImageDraw.Draw(bg_img)
         
-        f_bold = get_font(size=36, bold=True)
-        f_reg = get_font(size=24, bold=False)
+        f_bold = get_font(*FONT_TITLE)
+        f_reg = get_font(*FONT_BODY)
+        f_meta = get_font(*FONT_META)
 
-        title = data.get("title") or data.get("name")
-        year = (data.get("release_date") or data.get("first_air_date") or "----")[:4]
+        title = get_title(data)
+        year = get_year(data)
         if data.get('is_manual'): year = ""
 
-        draw.text((480, 80), f"{title} {year}", font=f_bold, fill="white", stroke_width=1, stroke_fill="black")
+        draw.text((TEXT_X, 60), f"{title} {year}", font=f_bold, fill="white", stroke_width=1, stroke_fill="black")
         
         if not data.get('is_manual'):
-            draw.text((480, 140), f"⭐ {data.get('vote_average', 0):.1f}/10", font=f_reg, fill="#00e676")
-            draw.text((480, 180), " | ".join([g["name"] for g in data.get("genres", [])]), font=get_font(18), fill="#00bcd4")
+            draw.text((TEXT_X, 105), f"⭐ {data.get('vote_average', 0):.1f}/10", font=f_meta, fill="#00e676")
+            draw.text((TEXT_X, 135), " | ".join([g["name"] for g in data.get("genres", [])]), font=get_font(*FONT_GENRES), fill="#00bcd4")
         
         overview = data.get("overview", "")
-        lines = [overview[i:i+80] for i in range(0, len(overview), 80)][:6]
-        y_text = 250
-        for line in lines:
-            draw.text((480, y_text), line, font=f_reg, fill="#E0E0E0")
-            y_text += 30
+        wrapped = "\n".join(wrap_text_px(overview, f_reg, OVERVIEW_MAX_PX, 6))
+        draw.multiline_text((TEXT_X, 188), wrapped, font=f_reg, fill="#E0E0E0", spacing=5)
             
+        # Photographic card: JPEG encodes far faster and smaller than PNG, and
+        # Telegram re-encodes photos anyway
         img_buffer = io.BytesIO()
-        img_buffer.name = "poster.png"
-        bg_img.save(img_buffer, format="PNG")
-        img_buffer.seek(0)
+        bg_img.save(img_buffer, format="JPEG", quality=85, optimize=False, progressive=False)
+        # Free the pixel buffers now rather than whenever the frame is collected
+        bg_img.close()
+        poster_img.close()
         
-        return img_buffer, poster_bytes 
+        # Plain bytes so the result pickles cheaply back from the process pool
+        return img_buffer.getvalue(), badged_bytes
     except Exception as e:
         logger.error(f"Img Gen Error: {e}")
         return None, None
+    finally:
+        collect_render_garbage()
+
+# Finished cards for TMDB titles; re-posts of the same title+badge skip download and render
+RENDER_CACHE_SIZE = 32
+render_cache = OrderedDict()  # (media, id, badge) -> [card_jpeg, badged_jpeg, catbox upload task]
+
+def render_cache_key(data):
+    if data.get('is_manual') or not data.get('id'):
+        return None  # manual posters are one-off uploads
+    return ("movie" if "title" in data else "tv", data['id'], data.get('badge_text'))
 
 # ---- BOT INIT ----
 try:
@@ -580,7 +1048,7 @@ except Exception as e:
 
 @bot.on_message(filters.command("start") & filters.private)
 async def start_cmd(client, message):
-    user_conversations.pop(message.from_user.id, None)
+    drop_convo(message.from_user.id)
     await message.reply_text(
         "🎬 **Movie & Series Bot (RGB, Dark & Profit v10)**\n\n"
         "⚡ `/post <Link or Name>` - Auto Post\n"
@@ -603,7 +1071,7 @@ async def set_ad(client, message):
         valid_links = [l for l in raw_links if l.startswith("http")]
         if valid_links:
             user_ad_links[message.from_user.id] = valid_links
-            save_json(USER_AD_LINKS_FILE, user_ad_links)
+            schedule_save(message.from_user.id)
             links_str = "\n".join([f"{i+1}. {l}" for i, l in enumerate(valid_links)])
             await message.reply_text(f"✅ **Ad Links Saved!** ({len(valid_links)} links)\n\n{links_str}")
         else:
@@ -614,13 +1082,17 @@ async def set_ad(client, message):
 @bot.on_message(filters.command("manual") & filters.private)
 async def manual_post_cmd(client, message):
     uid = message.from_user.id
-    user_conversations[uid] = {
-        "details": {"is_manual": True}, 
-        "links": [], 
-        "state": "manual_title"
-    }
+    async with user_lock(uid):
+        set_convo(uid, Convo(details={"is_manual": True}, state="manual_title"))
     await message.reply_text("✍️ **Manual Post Started**\n\nপ্রথমে **টাইটেল (Title)** লিখুন:")
 
+# Telegram keyboards get unwieldy past ~10 rows, and long titles get cut mid-word
+MAX_RESULT_BUTTONS = 10
+BUTTON_TITLE_MAX = 60
+
+def shorten(text, limit):
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
 @bot.on_message(filters.command("post") & filters.private)
 async def post_cmd(client, message):
     if len(message.command) < 2:
@@ -633,45 +1105,51 @@ async def post_cmd(client, message):
 
     if m_type and m_id:
         if m_type == "imdb":
-            find_url = f"https://api.themoviedb.org/3/find/{m_id}?api_key={TMDB_API_KEY}&external_source=imdb_id"
-            data = await fetch_url(find_url)
-            results = data.get("movie_results", []) + data.get("tv_results", [])
+            find_url = (TMDB_API_BASE / "find" / m_id).with_query(
+                {"api_key": TMDB_API_KEY, "external_source": "imdb_id"}
+            )
+            data = await fetch_tmdb(find_url) or {}
+            results = [("movie", r) for r in data.get("movie_results", [])] + [("tv", r) for r in data.get("tv_results", [])]
             if results:
-                m_type = results[0]['media_type']
-                m_id = results[0]['id']
+                m_type, first = results[0]
+                m_id = first['id']
             else:
                 return await msg.edit_text("❌ IMDb ID not found in TMDB database.")
 
         details = await get_tmdb_details(m_type, m_id)
         if not details: return await msg.edit_text("❌ Details not found from Link.")
         
-        user_conversations[message.from_user.id] = {
-            "details": details, "links": [], "state": "wait_lang"
-        }
-        await msg.edit_text(f"✅ Found: **{details.get('title') or details.get('name')}**\n\n🗣️ Enter **Language** (e.g. Hindi):")
+        uid = message.from_user.id
+        async with user_lock(uid):
+            set_convo(uid, Convo(details=details, state="wait_lang", img_task=asyncio.create_task(fetch_images(details))))
+        await msg.edit_text(f"✅ Found: **{get_title(details)}**\n\n🗣️ Enter **Language** (e.g. Hindi):")
         return
 
     results = await search_tmdb(query)
     if not results: return await msg.edit_text("❌ No results found.")
     
-    buttons = []
-    for r in results:
-        btn_text = f"{r.get('title') or r.get('name')} ({str(r.get('release_date') or '----')[:4]})"
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"sel_{r['media_type']}_{r['id']}")])
+    buttons = [
+        [InlineKeyboardButton(
+            f"{shorten(get_title(r) or '', BUTTON_TITLE_MAX)} ({get_year(r)})",
+            callback_data=f"sel_{r['media_type']}_{r['id']}"
+        )]
+        for r in results[:MAX_RESULT_BUTTONS]
+    ]
     
+    prefetch_details(results)
     await msg.edit_text("👇 **Select Content:**", reply_markup=InlineKeyboardMarkup(buttons))
 
-@bot.on_callback_query(filters.regex("^sel_"))
-async def on_select(client, cb):
+# ---- CALLBACKS (routed by on_callback in _CB_HANDLERS; payload is the data after the first "_") ----
+async def on_select(client, cb, payload):
     try:
-        _, m_type, m_id = cb.data.split("_")
+        m_type, m_id = payload.split("_")
         details = await get_tmdb_details(m_type, m_id)
         if not details: return await cb.message.edit_text("❌ Details not found.")
 
-        user_conversations[cb.from_user.id] = {
-            "details": details, "links": [], "state": "wait_lang"
-        }
-        await cb.message.edit_text(f"✅ Selected: **{details.get('title') or details.get('name')}**\n\n🗣️ Enter **Language** (e.g. Hindi):")
+        uid = cb.from_user.id
+        async with user_lock(uid):
+            set_convo(uid, Convo(details=details, state="wait_lang", img_task=asyncio.create_task(fetch_images(details))))
+        await cb.message.edit_text(f"✅ Selected: **{get_title(details)}**\n\n🗣️ Enter **Language** (e.g. Hindi):")
     except Exception as e:
         logger.error(f"Select Error: {e}")
 
@@ -681,79 +1159,99 @@ async def text_handler(client, message):
     uid = message.from_user.id
     if uid not in user_conversations: return
     
-    convo = user_conversations[uid]
-    state = convo.get("state")
-    text = message.text.strip() if message.text else ""
-    
-    if state == "manual_title":
-        convo["details"]["title"] = text
-        convo["state"] = "manual_plot"
-        await message.reply_text("📝 এবার মুভির **গল্প/Plot** লিখুন:")
-        
-    elif state == "manual_plot":
-        convo["details"]["overview"] = text
-        convo["state"] = "manual_poster"
-        await message.reply_text("🖼️ এবার একটি **পোস্টার (Photo)** সেন্ড করুন:")
-        
-    elif state == "manual_poster":
-        if not message.photo: return await message.reply_text("⚠️ দয়া করে একটি ছবি (Photo) পাঠান।")
-        msg = await message.reply_text("⏳ Processing Image...")
-        try:
-            photo_path = await message.download()
-            img_url = upload_to_catbox(photo_path)
-            os.remove(photo_path)
-            if img_url:
-                convo["details"]["manual_poster_url"] = img_url
-                convo["state"] = "ask_links"
-                buttons = [[InlineKeyboardButton("➕ Add Links", callback_data=f"lnk_yes_{uid}")], [InlineKeyboardButton("🏁 Finish", callback_data=f"lnk_no_{uid}")]]
-                await msg.edit_text("✅ ছবি আপলোড হয়েছে!\n\n🔗 এবার ডাউনলোড লিংক অ্যাড করবেন?", reply_markup=InlineKeyboardMarkup(buttons))
-            else: await msg.edit_text("❌ ইমেজ আপলোড ফেইল হয়েছে।")
-        except: await msg.edit_text("❌ এরর হয়েছে।")
-
-    elif state == "wait_lang":
-        convo["details"]["custom_language"] = text
-        convo["state"] = "wait_quality"
-        await message.reply_text("💿 Enter **Quality** (e.g. 720p):")
-        
-    elif state == "wait_quality":
-        convo["details"]["custom_quality"] = text
-        convo["state"] = "ask_links"
-        buttons = [[InlineKeyboardButton("➕ Add Links", callback_data=f"lnk_yes_{uid}")], [InlineKeyboardButton("🏁 Finish", callback_data=f"lnk_no_{uid}")]]
-        await message.reply_text("🔗 Add Download Links?", reply_markup=InlineKeyboardMarkup(buttons))
-        
-    elif state == "wait_link_name":
-        convo["temp_name"] = text
-        convo["state"] = "wait_link_url"
-        await message.reply_text("🔗 Enter **URL** for this button:")
-        
-    elif state == "wait_link_url":
-        if text.startswith("http"):
-            convo["links"].append({"label": convo["temp_name"], "url": text})
-            convo["state"] = "ask_links"
-            buttons = [[InlineKeyboardButton("➕ Add Another", callback_data=f"lnk_yes_{uid}")], [InlineKeyboardButton("🏁 Finish", callback_data=f"lnk_no_{uid}")]]
-            await message.reply_text(f"✅ Added! Total: {len(convo['links'])}", reply_markup=InlineKeyboardMarkup(buttons))
-        else:
-            await message.reply_text("⚠️ Invalid URL. Try again.")
-    
-    elif state == "wait_badge_text":
-        convo["details"]["badge_text"] = text
-        await message.reply_text(f"✅ ব্যাজ যুক্ত করা হচ্ছে: **{text}**\n\n🕵️‍♂️ **Detecting Faces to avoid covering...**\n⏳ Generating Final Post...")
-        await generate_final_post(client, uid, message)
-
-@bot.on_callback_query(filters.regex("^lnk_"))
-async def link_cb(client, cb):
+    async with user_lock(uid):
+        await handle_conversation(client, message, uid)
+
+# ---- CONVERSATION STATES (one handler per state, looked up in _STATE_HANDLERS) ----
+async def on_manual_title(client, message, uid, convo, text):
+    convo.details["title"] = text
+    convo.state = "manual_plot"
+    await message.reply_text("📝 এবার মুভির **গল্প/Plot** লিখুন:")
+
+async def on_manual_plot(client, message, uid, convo, text):
+    convo.details["overview"] = text
+    convo.state = "manual_poster"
+    await message.reply_text("🖼️ এবার একটি **পোস্টার (Photo)** সেন্ড করুন:")
+
+async def on_manual_poster(client, message, uid, convo, text):
+    if not message.photo: return await message.reply_text("⚠️ দয়া করে একটি ছবি (Photo) পাঠান।")
+    msg = await message.reply_text("⏳ Processing Image...")
     try:
-        action, uid_str = cb.data.rsplit("_", 1)
+        photo = await message.download(in_memory=True)
+        img_url = await upload_to_catbox_bytes(photo.getvalue())
+        if img_url:
+            convo.details["manual_poster_url"] = img_url
+            convo.state = "ask_links"
+            buttons = [[InlineKeyboardButton("➕ Add Links", callback_data=f"lnk_yes_{uid}")], [InlineKeyboardButton("🏁 Finish", callback_data=f"lnk_no_{uid}")]]
+            await msg.edit_text("✅ ছবি আপলোড হয়েছে!\n\n🔗 এবার ডাউনলোড লিংক অ্যাড করবেন?", reply_markup=InlineKeyboardMarkup(buttons))
+        else: await msg.edit_text("❌ ইমেজ আপলোড ফেইল হয়েছে।")
+    except: await msg.edit_text("❌ এরর হয়েছে।")
+
+async def on_wait_lang(client, message, uid, convo, text):
+    convo.details["custom_language"] = text
+    convo.state = "wait_quality"
+    await message.reply_text("💿 Enter **Quality** (e.g. 720p):")
+
+async def on_wait_quality(client, message, uid, convo, text):
+    convo.details["custom_quality"] = text
+    convo.state = "ask_links"
+    buttons = [[InlineKeyboardButton("➕ Add Links", callback_data=f"lnk_yes_{uid}")], [InlineKeyboardButton("🏁 Finish", callback_data=f"lnk_no_{uid}")]]
+    await message.reply_text("🔗 Add Download Links?", reply_markup=InlineKeyboardMarkup(buttons))
+
+async def on_wait_link_name(client, message, uid, convo, text):
+    convo.temp_name = text
+    convo.state = "wait_link_url"
+    await message.reply_text("🔗 Enter **URL** for this button:")
+
+async def on_wait_link_url(client, message, uid, convo, text):
+    if text.startswith("http"):
+        convo.links.append({"label": convo.temp_name, "url": text})
+        convo.state = "ask_links"
+        buttons = [[InlineKeyboardButton("➕ Add Another", callback_data=f"lnk_yes_{uid}")], [InlineKeyboardButton("🏁 Finish", callback_data=f"lnk_no_{uid}")]]
+        await message.reply_text(f"✅ Added! Total: {len(convo.links)}", reply_markup=InlineKeyboardMarkup(buttons))
+    else:
+        await message.reply_text("⚠️ Invalid URL. Try again.")
+
+async def on_wait_badge_text(client, message, uid, convo, text):
+    convo.details["badge_text"] = text
+    await message.reply_text(f"✅ ব্যাজ যুক্ত করা হচ্ছে: **{text}**\n\n🕵️‍♂️ **Detecting Faces to avoid covering...**\n⏳ Generating Final Post...")
+    await generate_final_post(client, uid, message)
+
+_STATE_HANDLERS = {
+    "manual_title": on_manual_title,
+    "manual_plot": on_manual_plot,
+    "manual_poster": on_manual_poster,
+    "wait_lang": on_wait_lang,
+    "wait_quality": on_wait_quality,
+    "wait_link_name": on_wait_link_name,
+    "wait_link_url": on_wait_link_url,
+    "wait_badge_text": on_wait_badge_text,
+}
+
+async def handle_conversation(client, message, uid):
+    convo = get_convo(uid)
+    if convo is None: return
+    handler = _STATE_HANDLERS.get(convo.state)
+    if handler:
+        text = message.text.strip() if message.text else ""
+        await handler(client, message, uid, convo, text)
+
+async def link_cb(client, cb, payload):
+    try:
+        action, _, uid_str = payload.partition("_")
         uid = int(uid_str)
     except: return
     
     if uid != cb.from_user.id: return await cb.answer("Not for you!", show_alert=True)
     
-    if action == "lnk_yes":
-        user_conversations[uid]["state"] = "wait_link_name"
+    async with user_lock(uid):
+        convo = get_convo(uid)
+        if convo is None: return await cb.answer("Session expired.", show_alert=True)
+        convo.state = "wait_link_name" if action == "yes" else "wait_badge_text"
+    
+    if action == "yes":
         await cb.message.edit_text("📝 বাটনের নাম লিখুন (Ex: '720p Download' or 'Watch Online'):")
     else:
-        user_conversations[uid]["state"] = "wait_badge_text"
         btns = [[InlineKeyboardButton("🚫 Skip Badge (No Text)", callback_data=f"skip_badge_{uid}")]]
         await cb.message.edit_text(
             "🖼️ **পোস্টারে কোনো লেখা (Badge) বসাতে চান?**\n\n"
@@ -763,74 +1261,180 @@ async def link_cb(client, cb):
             reply_markup=InlineKeyboardMarkup(btns)
         )
 
-@bot.on_callback_query(filters.regex("^skip_badge_"))
-async def skip_badge_cb(client, cb):
-    uid = int(cb.data.split("_")[-1])
-    if uid in user_conversations:
-        user_conversations[uid]["details"]["badge_text"] = None
+async def skip_badge_cb(client, cb, payload):
+    uid = int(payload.rpartition("_")[2])
+    async with user_lock(uid):
+        convo = get_convo(uid)
+        if convo is None: return
+        convo.details["badge_text"] = None
         await cb.message.edit_text("⏳ Generating Final Post...")
         await generate_final_post(client, uid, cb.message)
 
+# Still running, or finished with a URL
+def upload_usable(task):
+    if task is None: return False
+    return not task.done() or (not task.cancelled() and task.result() is not None)
+
+# Callers must hold user_lock(uid)
 async def generate_final_post(client, uid, message):
-    if uid not in user_conversations: return await message.edit_text("❌ Session expired.")
-    convo = user_conversations[uid]
+    convo = get_convo(uid)
+    if convo is None: return await message.edit_text("❌ Session expired.")
     
     loop = asyncio.get_running_loop()
     
-    img_io, poster_bytes = await loop.run_in_executor(None, generate_image, convo["details"])
-    
-    if convo["details"].get("badge_text") and poster_bytes:
-        new_poster_url = await loop.run_in_executor(None, upload_to_catbox_bytes, poster_bytes)
-        if new_poster_url:
-            convo["details"]["manual_poster_url"] = new_poster_url 
-    
-    my_ad_links = user_ad_links.get(uid, DEFAULT_AD_LINKS)
-    html = generate_html_code(convo["details"], convo["links"], my_ad_links)
+    key = render_cache_key(convo.details)
+    entry = render_cache.get(key) if key else None
+    if entry:
+        render_cache.move_to_end(key)
+    else:
+        # TMDB flows start downloading artwork as soon as details arrive
+        poster_b, backdrop_b = await (convo.img_task or fetch_images(convo.details))
+        img_bytes, badged_bytes = await loop.run_in_executor(CPU_POOL, render_image, poster_b, backdrop_b, convo.details)
+        entry = [img_bytes, badged_bytes, None]
+        if key and img_bytes:
+            render_cache[key] = entry
+            while len(render_cache) > RENDER_CACHE_SIZE:
+                render_cache.popitem(last=False)
+    img_bytes, badged_bytes, upload_task = entry
+    img_io = None
+    if img_bytes:
+        img_io = io.BytesIO(img_bytes)
+        img_io.name = "poster.jpg"
     
-    caption = generate_formatted_caption(convo["details"])
-    convo["final"] = {"html": html}
+    # The catbox copy of the badged poster is only needed by the HTML, which is
+    # built when "Get Blogger Code" is pressed; upload in the background till then.
+    # A cached card keeps its upload, so reposts share it unless it failed
+    convo.posted = False
+    convo.html_bytes = None
+    if badged_bytes and not upload_usable(upload_task):
+        upload_task = entry[2] = asyncio.create_task(upload_to_catbox_bytes(badged_bytes))
+    convo.upload_task = upload_task
     
+    caption = generate_formatted_caption(convo.details)
     btns = [[InlineKeyboardButton("📄 Get Blogger Code", callback_data=f"get_code_{uid}")]]
     
     try:
         if img_io:
             await client.send_photo(message.chat.id, img_io, caption=caption, reply_markup=InlineKeyboardMarkup(btns))
+            convo.posted = True
             await message.delete()
         else:
             await message.edit_text(caption, reply_markup=InlineKeyboardMarkup(btns))
+            convo.posted = True
     except Exception as e:
         logger.error(f"Post Send Error: {e}")
         await message.edit_text("❌ Error sending post.")
 
-@bot.on_callback_query(filters.regex("^get_code_"))
-async def get_code(client, cb):
+# Callers hold the user's lock and have waited for convo.upload_task
+def get_post_html(uid, convo):
+    if convo.html_bytes is None:
+        if convo.upload_task:
+            new_poster_url = None if convo.upload_task.cancelled() else convo.upload_task.result()
+            convo.upload_task = None
+            if new_poster_url:
+                convo.details["manual_poster_url"] = new_poster_url 
+        my_ad_links = user_ad_links.get(uid, DEFAULT_AD_LINKS)
+        post_html = generate_html_code(convo.details, convo.links, my_ad_links)
+        # UTF-8 bytes: the Bengali rules text would make the str 2 bytes/char resident
+        convo.html_bytes = post_html.encode()
+    return convo.html_bytes
+
+async def get_code(client, cb, payload):
     try:
-        _, _, uid_str = cb.data.rsplit("_", 2)
-        uid = int(uid_str)
+        uid = int(payload.rpartition("_")[2])
     except: return
 
-    data = user_conversations.get(uid, {})
-    if "final" not in data: return await cb.answer("Expired.", show_alert=True)
+    async with user_lock(uid):
+        convo = get_convo(uid)
+        if convo is None or not convo.posted: return await cb.answer("Expired.", show_alert=True)
+        await cb.answer("⏳ Uploading to Dpaste...", show_alert=False)
+    
+    # The poster upload can take up to a minute: wait for it outside the lock so
+    # the user's other messages aren't queued behind it. A re-badged post swaps in
+    # a new task meanwhile, so look again once the lock is back
+    while True:
+        async with user_lock(uid):
+            convo = get_convo(uid)
+            if convo is None or not convo.posted: return
+            task = convo.upload_task
+            if task is None or task.done():
+                html_bytes = get_post_html(uid, convo)
+                break
+        await asyncio.shield(task)
     
-    await cb.answer("⏳ Uploading to Dpaste...", show_alert=False)
-    link = await create_paste_link(data["final"]["html"])
+    link = await create_paste_link(html_bytes)
     
     if link:
         await cb.message.reply_text(f"✅ **Code Ready!**\n\n👇 Copy:\n{link}", disable_web_page_preview=True)
     else:
-        file = io.BytesIO(data["final"]["html"].encode())
+        file = io.BytesIO(html_bytes)
         file.name = "blogger_post.html"
         await client.send_document(cb.message.chat.id, file, caption="⚠️ Link failed. File attached.")
 
+# Keyed on the callback_data text before the first "_" (skip_badge_ -> "skip", get_code_ -> "get")
+_CB_HANDLERS = {
+    "sel": on_select,
+    "lnk": link_cb,
+    "skip": skip_badge_cb,
+    "get": get_code,
+}
+
+@bot.on_callback_query()
+async def on_callback(client, cb):
+    prefix, _, payload = (cb.data or "").partition("_")
+    handler = _CB_HANDLERS.get(prefix)
+    if handler:
+        await handler(client, cb, payload)
+
+# ---- STARTUP / SHUTDOWN ----
+background_tasks = []
+
+# Render workers start from a fresh interpreter (forkserver, or spawn where that
+# is missing) rather than a fork of this already-threaded process; each imports
+# bot.py and loads its fonts and cascade once here
+RENDER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def init_render_worker():
+    preload_fonts()
+    get_face_cascade()
+
+async def on_startup():
+    global CPU_POOL
+    init_storage()
+    await setup_resources()
+    # Leave one core for the event loop and pyrogram's crypto; keep at least two renderers
+    CPU_POOL = ProcessPoolExecutor(
+        max_workers=max(2, (os.cpu_count() or 2) - 1),
+        mp_context=multiprocessing.get_context(RENDER_START_METHOD),
+        initializer=init_render_worker
+    )
+    await start_web_server()
+    background_tasks.append(asyncio.create_task(conversation_sweeper()))
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    if _flush_task and not _flush_task.done():
+        _flush_task.cancel()
+    flush_pending_saves()
+    if web_runner:
+        await web_runner.cleanup()
+    if HTTP_SESSION and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    if CPU_POOL:
+        CPU_POOL.shutdown(wait=False, cancel_futures=True)
+
+async def main():
+    await on_startup()
+    try:
+        await bot.start()
+        print("🚀 Bot Started (Smart Face Detect & Profit v11)!")
+        await idle()
+    finally:
+        if bot.is_connected:
+            await bot.stop()
+        await on_shutdown()
+
 # ---- ENTRY POINT ----
 if __name__ == "__main__":
-    flask_thread = Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-    
-    ping_thread = Thread(target=keep_alive_pinger)
-    ping_thread.daemon = True
-    ping_thread.start()
-    
-    print("🚀 Bot Started (Smart Face Detect & Profit v11)!")
-    bot.run()
+    bot.run(main())